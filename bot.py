@@ -1,14 +1,23 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramAPIError
 import os
 from dotenv import load_dotenv
-from logic import ChatGPTHandler, ImageGenerator, UserManager
+
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows
+    uvloop = None
+from logic import ChatGPTHandler, ImageGenerator, UserManager, config_manager, http_client, make_openai_client
 
 load_dotenv()
 
@@ -25,22 +34,145 @@ bot = Bot(token=TELEGRAM_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
-chatgpt_handler = ChatGPTHandler(OPENAI_API_KEY)
-image_generator = ImageGenerator(OPENAI_API_KEY)
+openai_client = make_openai_client(OPENAI_API_KEY)
+chatgpt_handler = ChatGPTHandler(openai_client)
+image_generator = ImageGenerator(openai_client)
 user_manager = UserManager()
 
 class BotStates(StatesGroup):
     waiting_for_message = State()
     waiting_for_image_prompt = State()
 
-def get_main_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💬 Чат с ИИ", callback_data="chat_ai")],
-        [InlineKeyboardButton(text="🎨 Генерация изображений", callback_data="generate_image")],
-        [InlineKeyboardButton(text="📊 Моя статистика", callback_data="stats")],
-        [InlineKeyboardButton(text="🔄 Очистить историю", callback_data="clear_history")]
-    ])
-    return keyboard
+# Ограничение частоты сообщений (token bucket на пользователя):
+# лишние сообщения отклоняются ещё до обращения к OpenAI
+class RateLimitMiddleware(BaseMiddleware):
+    def __init__(self, capacity: float = 10, max_users: int = 10000):
+        self.capacity = capacity
+        self.rate = config_manager.get("rate_limits", {}).get("messages_per_minute", 10) / 60
+        # user_id -> (last_refill, tokens, warned); LRU, давно неактивные вытесняются
+        self.buckets: "OrderedDict[int, Tuple[float, float, bool]]" = OrderedDict()
+        self.max_users = max_users
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        if event.from_user is None:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            last_refill, tokens, warned = now, self.capacity, False
+        else:
+            last_refill, tokens, warned = bucket
+            self.buckets.move_to_end(user_id)
+        tokens = min(self.capacity, tokens + (now - last_refill) * self.rate)
+
+        if tokens < 1:
+            self.buckets[user_id] = (now, tokens, True)
+            # Предупреждаем один раз, иначе флуд порождал бы столько же ответов бота
+            if not warned:
+                await event.answer("⏳ Слишком часто! Подождите немного и попробуйте снова.")
+            return None
+
+        self.buckets[user_id] = (now, tokens - 1, False)
+        if len(self.buckets) > self.max_users:
+            self.buckets.popitem(last=False)
+        return await handler(event, data)
+
+# Одна отложенная запись статистики на диск после обработки апдейта,
+# сколько бы счётчиков ни изменил обработчик
+class FlushStatsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            user_manager.schedule_flush()
+
+dp.message.middleware(RateLimitMiddleware())
+dp.update.outer_middleware(FlushStatsMiddleware())
+
+# Клавиатуры не меняются, поэтому создаются один раз при запуске
+MAIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💬 Чат с ИИ", callback_data="chat_ai")],
+    [InlineKeyboardButton(text="🎨 Генерация изображений", callback_data="generate_image")],
+    [InlineKeyboardButton(text="📊 Моя статистика", callback_data="stats")],
+    [InlineKeyboardButton(text="🔄 Очистить историю", callback_data="clear_history")]
+])
+
+BACK_TO_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_menu")]
+])
+
+HOME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
+])
+
+IMAGE_FOLLOWUP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🎨 Создать еще", callback_data="generate_image")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
+])
+
+WELCOME_TMPL = (
+    "👋 Привет, {}!\n\n"
+    "Я многофункциональный ИИ-бот с возможностями:\n"
+    "💬 Общение с ChatGPT\n"
+    "🎨 Генерация изображений с помощью DALL-E\n\n"
+    "Выберите действие из меню ниже:"
+).format
+
+HELP_TEXT = (
+    "🤖 <b>Доступные команды:</b>\n\n"
+    "/start - Главное меню\n"
+    "/help - Помощь\n"
+    "/stats - Статистика использования\n"
+    "/clear - Очистить историю чата\n\n"
+    "<b>Возможности бота:</b>\n"
+    "💬 Общение с ChatGPT - задавайте любые вопросы\n"
+    "🎨 Генерация изображений - создавайте картинки по описанию\n"
+    "📊 Статистика - отслеживание использования\n"
+    "🔄 Очистка истории - начать диалог заново"
+)
+
+CHAT_MODE_TEXT = (
+    "💬 <b>Режим чата с ИИ активирован</b>\n\n"
+    "Напишите ваше сообщение, и я отвечу с помощью ChatGPT.\n"
+    "Для возврата в меню используйте /start"
+)
+
+IMAGE_MODE_TEXT = (
+    "🎨 <b>Режим генерации изображений активирован</b>\n\n"
+    "Опишите изображение, которое хотите создать.\n"
+    "Например: 'кот в космосе среди звезд'\n\n"
+    "Для возврата в меню используйте /start"
+)
+
+CLEAR_TEXT = (
+    "🔄 <b>История чата очищена</b>\n\n"
+    "Теперь ИИ не помнит предыдущие сообщения."
+)
+
+MENU_TEXT = (
+    "🏠 <b>Главное меню</b>\n\n"
+    "Выберите действие:"
+)
+
+STATS_TMPL = (
+    "📊 <b>Ваша статистика:</b>\n\n"
+    "💬 Сообщений в чате: {messages_sent}\n"
+    "🎨 Изображений создано: {images_generated}\n"
+    "📅 Дата регистрации: {registration_date}\n"
+    "🕒 Последняя активность: {last_activity}"
+).format
 
 @dp.message(Command("start"))
 async def start_command(message: Message, state: FSMContext):
@@ -49,82 +181,39 @@ async def start_command(message: Message, state: FSMContext):
 
     user_manager.register_user(user_id, username)
 
-    welcome_text = (
-        f"👋 Привет, {username}!\n\n"
-        "Я многофункциональный ИИ-бот с возможностями:\n"
-        "💬 Общение с ChatGPT\n"
-        "🎨 Генерация изображений с помощью DALL-E\n\n"
-        "Выберите действие из меню ниже:"
-    )
-
-    await message.answer(welcome_text, reply_markup=get_main_menu())
+    await message.answer(WELCOME_TMPL(username), reply_markup=MAIN_MENU)
     await state.clear()
 
 @dp.message(Command("help"))
 async def help_command(message: Message):
-    help_text = (
-        "🤖 <b>Доступные команды:</b>\n\n"
-        "/start - Главное меню\n"
-        "/help - Помощь\n"
-        "/stats - Статистика использования\n"
-        "/clear - Очистить историю чата\n\n"
-        "<b>Возможности бота:</b>\n"
-        "💬 Общение с ChatGPT - задавайте любые вопросы\n"
-        "🎨 Генерация изображений - создавайте картинки по описанию\n"
-        "📊 Статистика - отслеживание использования\n"
-        "🔄 Очистка истории - начать диалог заново"
-    )
-    await message.answer(help_text, parse_mode="HTML", reply_markup=get_main_menu())
+    await message.answer(HELP_TEXT, parse_mode="HTML", reply_markup=MAIN_MENU)
 
-@dp.callback_query(lambda c: c.data == "chat_ai")
+@dp.callback_query(F.data == "chat_ai")
 async def chat_ai_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
 
-    await callback_query.message.edit_text(
-        "💬 <b>Режим чата с ИИ активирован</b>\n\n"
-        "Напишите ваше сообщение, и я отвечу с помощью ChatGPT.\n"
-        "Для возврата в меню используйте /start",
-        parse_mode="HTML"
-    )
+    await callback_query.message.edit_text(CHAT_MODE_TEXT, parse_mode="HTML")
 
     await state.set_state(BotStates.waiting_for_message)
 
-@dp.callback_query(lambda c: c.data == "generate_image")
+@dp.callback_query(F.data == "generate_image")
 async def generate_image_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
 
-    await callback_query.message.edit_text(
-        "🎨 <b>Режим генерации изображений активирован</b>\n\n"
-        "Опишите изображение, которое хотите создать.\n"
-        "Например: 'кот в космосе среди звезд'\n\n"
-        "Для возврата в меню используйте /start",
-        parse_mode="HTML"
-    )
+    await callback_query.message.edit_text(IMAGE_MODE_TEXT, parse_mode="HTML")
 
     await state.set_state(BotStates.waiting_for_image_prompt)
 
-@dp.callback_query(lambda c: c.data == "stats")
+@dp.callback_query(F.data == "stats")
 async def stats_callback(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
     user_id = callback_query.from_user.id
     stats = user_manager.get_user_stats(user_id)
 
-    stats_text = (
-        f"📊 <b>Ваша статистика:</b>\n\n"
-        f"💬 Сообщений в чате: {stats['messages_sent']}\n"
-        f"🎨 Изображений создано: {stats['images_generated']}\n"
-        f"📅 Дата регистрации: {stats['registration_date']}\n"
-        f"🕒 Последняя активность: {stats['last_activity']}"
-    )
-
-    back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_menu")]
-    ])
-
-    await callback_query.message.edit_text(stats_text, parse_mode="HTML", reply_markup=back_keyboard)
+    await callback_query.message.edit_text(STATS_TMPL(**stats), parse_mode="HTML", reply_markup=BACK_TO_MENU_KB)
 
-@dp.callback_query(lambda c: c.data == "clear_history")
+@dp.callback_query(F.data == "clear_history")
 async def clear_history_callback(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
@@ -132,22 +221,20 @@ async def clear_history_callback(callback_query: types.CallbackQuery):
     chatgpt_handler.clear_history(user_id)
 
     await callback_query.message.edit_text(
-        "🔄 <b>История чата очищена</b>\n\n"
-        "Теперь ИИ не помнит предыдущие сообщения.",
+        CLEAR_TEXT,
         parse_mode="HTML",
-        reply_markup=get_main_menu()
+        reply_markup=MAIN_MENU
     )
 
-@dp.callback_query(lambda c: c.data == "back_to_menu")
+@dp.callback_query(F.data == "back_to_menu")
 async def back_to_menu_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
     await state.clear()
 
     await callback_query.message.edit_text(
-        "🏠 <b>Главное меню</b>\n\n"
-        "Выберите действие:",
+        MENU_TEXT,
         parse_mode="HTML",
-        reply_markup=get_main_menu()
+        reply_markup=MAIN_MENU
     )
 
 @dp.message(BotStates.waiting_for_message)
@@ -158,21 +245,25 @@ async def handle_chat_message(message: Message, state: FSMContext):
     await bot.send_chat_action(message.chat.id, "typing")
 
     try:
-        response = await chatgpt_handler.get_response(user_id, user_message)
+        sent = await message.answer("…")
 
-        user_manager.increment_messages(user_id)
+        async def on_chunk(text: str):
+            try:
+                await sent.edit_text(text)
+            except TelegramAPIError as e:
+                logger.debug(f"Не удалось обновить сообщение при стриминге: {e}")
 
-        back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-        ])
+        response = await chatgpt_handler.stream_response(user_id, user_message, on_chunk)
+
+        user_manager.increment_messages(user_id)
 
-        await message.answer(response, reply_markup=back_keyboard)
+        await sent.edit_text(response, reply_markup=HOME_KB)
 
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         await message.answer(
             "❌ Произошла ошибка при обработке сообщения. Попробуйте еще раз.",
-            reply_markup=get_main_menu()
+            reply_markup=MAIN_MENU
         )
 
 @dp.message(BotStates.waiting_for_image_prompt)
@@ -188,28 +279,23 @@ async def handle_image_generation(message: Message, state: FSMContext):
         if image_url:
             user_manager.increment_images(user_id)
 
-            back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🎨 Создать еще", callback_data="generate_image")],
-                [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-            ])
-
             await message.answer_photo(
                 photo=image_url,
                 caption=f"🎨 <b>Изображение готово!</b>\n\nЗапрос: {prompt}",
                 parse_mode="HTML",
-                reply_markup=back_keyboard
+                reply_markup=IMAGE_FOLLOWUP_KB
             )
         else:
             await message.answer(
                 "❌ Не удалось создать изображение. Попробуйте изменить описание.",
-                reply_markup=get_main_menu()
+                reply_markup=MAIN_MENU
             )
 
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
         await message.answer(
             "❌ Произошла ошибка при создании изображения. Попробуйте еще раз.",
-            reply_markup=get_main_menu()
+            reply_markup=MAIN_MENU
         )
 
 @dp.message(Command("stats"))
@@ -217,15 +303,7 @@ async def stats_command(message: Message):
     user_id = message.from_user.id
     stats = user_manager.get_user_stats(user_id)
 
-    stats_text = (
-        f"📊 <b>Ваша статистика:</b>\n\n"
-        f"💬 Сообщений в чате: {stats['messages_sent']}\n"
-        f"🎨 Изображений создано: {stats['images_generated']}\n"
-        f"📅 Дата регистрации: {stats['registration_date']}\n"
-        f"🕒 Последняя активность: {stats['last_activity']}"
-    )
-
-    await message.answer(stats_text, parse_mode="HTML", reply_markup=get_main_menu())
+    await message.answer(STATS_TMPL(**stats), parse_mode="HTML", reply_markup=MAIN_MENU)
 
 @dp.message(Command("clear"))
 async def clear_command(message: Message):
@@ -234,25 +312,43 @@ async def clear_command(message: Message):
 
     await message.answer(
         "🔄 История чата очищена!",
-        reply_markup=get_main_menu()
+        reply_markup=MAIN_MENU
     )
 
 @dp.message()
 async def handle_unknown_message(message: Message):
     await message.answer(
         "🤔 Выберите действие из меню или используйте команды.",
-        reply_markup=get_main_menu()
+        reply_markup=MAIN_MENU
+    )
+
+async def warmup_openai_connections(count: int = 4):
+    # Заранее открываем TLS-соединения, чтобы первый пользователь не ждал рукопожатия
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    results = await asyncio.gather(
+        *(http_client.head("https://api.openai.com/v1/models", headers=headers, timeout=5.0)
+          for _ in range(count)),
+        return_exceptions=True
     )
+    failed = sum(isinstance(r, Exception) for r in results)
+    if failed:
+        logger.warning(f"Не удалось прогреть {failed} из {count} соединений с OpenAI")
 
 async def main():
     try:
         logger.info("Запуск бота...")
+        await warmup_openai_connections()
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        await user_manager.flush()
         await bot.session.close()
+        await http_client.aclose()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
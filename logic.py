@@ -1,20 +1,64 @@
 import openai
+import httpx
 import asyncio
 import logging
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import Dict, List, Optional
-import json
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional
+import hashlib
+import orjson
+import re
+import sqlite3
+import time
+from contextlib import closing
+from types import MappingProxyType
 import aiohttp
 
 logger = logging.getLogger(__name__)
 
+# Отформатированная метка времени и номер минуты, для которой она посчитана
+_ts_cache = ["", 0]
+
+
+def _now_str() -> str:
+    t = int(time.time()) // 60
+    if t != _ts_cache[1]:
+        _ts_cache[0] = datetime.fromtimestamp(t * 60).strftime("%Y-%m-%d %H:%M")
+        _ts_cache[1] = t
+    return _ts_cache[0]
+
+
+# Слова, при наличии которых промпт не дополняется — проверяются за один проход
+_QUALITY_WORDS_RE = re.compile(r"high quality|detailed|professional|beautiful|stunning", re.IGNORECASE)
+
+
+# Общий пул соединений с api.openai.com для чата и генерации изображений
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(60.0, connect=10.0)
+)
+
+
+def make_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    # Один клиент на весь бот: общий пул соединений и общий учёт лимитов
+    return openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+
 
 class ChatGPTHandler:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.client = openai.AsyncOpenAI(api_key=api_key)
-        self.user_histories: Dict[int, List[Dict]] = {}
+    def __init__(self, client: openai.AsyncOpenAI):
+        self.client = client
         self.max_history_length = 20  # Максимальное количество сообщений в истории
+        self.system_message = self._get_system_message()
+        # Системное сообщение хранится отдельно, в истории только диалог
+        self.user_histories: "OrderedDict[int, deque]" = OrderedDict()
+        # При превышении лимита вытесняется история самого давно активного пользователя
+        self.max_users = config_manager.get("max_cached_histories", 10000)
+        # Ограничиваем число одновременных запросов к API под лимиты тарифа
+        self._sem = asyncio.Semaphore(config_manager.get("openai_concurrency", 30))
+        # Промежуточные обновления при стриминге: не чаще раза в интервал и только
+        # если текст заметно вырос (лимиты Telegram на редактирование сообщений)
+        self.stream_interval = 0.5
+        self.stream_min_growth = 50
 
     def _get_system_message(self) -> Dict[str, str]:
         return {
@@ -30,34 +74,68 @@ class ChatGPTHandler:
 Ты хорошо разбираешься в Python, JavaScript, Java, C++, C#, HTML, CSS, Dart, TypeScript и других популярных языках."""
         }
 
-    def _get_user_history(self, user_id: int) -> List[Dict]:
-        if user_id not in self.user_histories:
-            self.user_histories[user_id] = [self._get_system_message()]
-        return self.user_histories[user_id]
+    def _get_user_history(self, user_id: int) -> deque:
+        history = self.user_histories.get(user_id)
+        if history is None:
+            # deque с maxlen сам вытесняет самые старые сообщения
+            history = deque(maxlen=self.max_history_length - 1)
+            self.user_histories[user_id] = history
+            if len(self.user_histories) > self.max_users:
+                self.user_histories.popitem(last=False)
+        else:
+            self.user_histories.move_to_end(user_id)
+        return history
 
     def _add_to_history(self, user_id: int, role: str, content: str):
-        history = self._get_user_history(user_id)
-        history.append({"role": role, "content": content})
+        self._get_user_history(user_id).append({"role": role, "content": content})
 
-        if len(history) > self.max_history_length:
-            system_msg = history[0]  # Сохраняем системное сообщение
-            recent_messages = history[-(self.max_history_length - 1):]
-            self.user_histories[user_id] = [system_msg] + recent_messages
-
-    async def get_response(self, user_id: int, message: str) -> str:
+    async def stream_response(self, user_id: int, message: str,
+                              on_chunk: Callable[[str], Awaitable[None]]) -> str:
         try:
             self._add_to_history(user_id, "user", message)
 
             history = self._get_user_history(user_id)
 
-            response = await self.client.chat.completions.create(
-                model="gpt-4.1",
-                messages=history,
-                max_tokens=1000,
-                temperature=0.7
-            )
-
-            assistant_response = response.choices[0].message.content
+            parts: List[str] = []
+            length = sent_length = 0
+            sent_at = time.monotonic()
+            # Промежуточные правки идут фоном по одной, чтобы не держать слот семафора
+            edit_task: Optional[asyncio.Task] = None
+
+            async with self._sem:
+                stream = await self.client.chat.completions.create(
+                    model="gpt-4.1",
+                    messages=[self.system_message, *history],
+                    max_tokens=1000,
+                    temperature=0.7,
+                    stream=True
+                )
+
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+
+                    parts.append(delta)
+                    length += len(delta)
+
+                    now = time.monotonic()
+                    if (
+                        (edit_task is None or edit_task.done())
+                        and now - sent_at >= self.stream_interval
+                        and length - sent_length > self.stream_min_growth
+                    ):
+                        edit_task = asyncio.create_task(self._send_chunk(on_chunk, "".join(parts)))
+                        sent_at = now
+                        sent_length = length
+
+            if edit_task is not None:
+                # Дожидаемся последней промежуточной правки, чтобы она не перезаписала итоговый ответ
+                await edit_task
+
+            assistant_response = "".join(parts)
 
             self._add_to_history(user_id, "assistant", assistant_response)
 
@@ -71,29 +149,79 @@ class ChatGPTHandler:
             logger.error(f"Ошибка ChatGPT API: {e}")
             return "❌ Произошла ошибка при обращении к ChatGPT. Попробуйте позже."
 
+    @staticmethod
+    async def _send_chunk(on_chunk: Callable[[str], Awaitable[None]], text: str):
+        # Промежуточные обновления необязательны: их ошибки не должны ломать ответ
+        try:
+            await on_chunk(text)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить промежуточный ответ: {e}")
+
     def clear_history(self, user_id: int):
-        self.user_histories[user_id] = [self._get_system_message()]
+        self._get_user_history(user_id).clear()
 
     def get_history_length(self, user_id: int) -> int:
-        return len(self._get_user_history(user_id)) - 1
+        return len(self._get_user_history(user_id))
 
 
 class ImageGenerator:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.client = openai.AsyncOpenAI(api_key=api_key)
+    def __init__(self, client: openai.AsyncOpenAI):
+        self.client = client
+        # У DALL-E 3 лимиты заметно жёстче, чем у чата
+        self._sem = asyncio.Semaphore(config_manager.get("image_concurrency", 5))
+        # Одинаковые одновременные запросы ждут один и тот же вызов API
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        # Недавние результаты: ключ -> (url, время). Ссылки DALL-E живут около часа
+        self._recent: "OrderedDict[bytes, tuple[str, float]]" = OrderedDict()
+        self.cache_ttl = config_manager.get("image_cache_ttl", 1800)
+        self.cache_size = 256
 
     async def generate_image(self, prompt: str, size: str = "1024x1024") -> Optional[str]:
+        enhanced_prompt = self._enhance_prompt(prompt)
+        key = hashlib.sha1(f"{size}:{enhanced_prompt}".encode()).digest()[:16]
+
+        cached = self._recent.get(key)
+        if cached is not None:
+            url, created = cached
+            if time.monotonic() - created < self.cache_ttl:
+                self._recent.move_to_end(key)
+                return url
+            del self._recent[key]
+
+        if key in self._inflight:
+            # shield: отмена одного ожидающего не должна отменять результат для остальных
+            return await asyncio.shield(self._inflight[key])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
         try:
-            enhanced_prompt = self._enhance_prompt(prompt)
-
-            response = await self.client.images.generate(
-                model="dall-e-3",
-                prompt=enhanced_prompt,
-                size=size,
-                quality="standard",
-                n=1
-            )
+            url = await self._generate(enhanced_prompt, size)
+            if not fut.done():
+                fut.set_result(url)
+        except asyncio.CancelledError:
+            if not fut.done():
+                fut.cancel()
+            raise
+        finally:
+            del self._inflight[key]
+
+        if url:
+            self._recent[key] = (url, time.monotonic())
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+        return url
+
+    async def _generate(self, enhanced_prompt: str, size: str) -> Optional[str]:
+        try:
+            async with self._sem:
+                response = await self.client.images.generate(
+                    model="dall-e-3",
+                    prompt=enhanced_prompt,
+                    size=size,
+                    quality="standard",
+                    n=1
+                )
 
             return response.data[0].url
 
@@ -108,86 +236,211 @@ class ImageGenerator:
             return None
 
     def _enhance_prompt(self, prompt: str) -> str:
-        quality_words = ["high quality", "detailed", "professional", "beautiful", "stunning"]
-
-        if not any(word in prompt.lower() for word in quality_words):
+        if not _QUALITY_WORDS_RE.search(prompt):
             prompt += ", high quality, detailed"
 
         return prompt[:1000]
 
 
+_USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    registration_date TEXT,
+    messages_sent INTEGER DEFAULT 0,
+    images_generated INTEGER DEFAULT 0,
+    last_activity TEXT
+)
+"""
+
+_UPSERT_USER = """
+INSERT INTO users (user_id, username, registration_date, messages_sent, images_generated, last_activity)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username = excluded.username,
+    messages_sent = excluded.messages_sent,
+    images_generated = excluded.images_generated,
+    last_activity = excluded.last_activity
+"""
+
+_UNKNOWN_USER_STATS = MappingProxyType({
+    "username": "Неизвестный",
+    "registration_date": "Не зарегистрирован",
+    "messages_sent": 0,
+    "images_generated": 0,
+    "last_activity": "Никогда"
+})
+
+
 class UserManager:
-    def __init__(self):
+    def __init__(self, db_path: str = "users.db", flush_delay: float = 2.0):
+        self.db_path = db_path
+        # Все пользователи держатся в памяти для чтения, в SQLite пишутся только изменённые строки
         self.users: Dict[int, Dict] = {}
+        self.flush_delay = flush_delay  # Не чаще одной записи на диск за этот интервал
+        self._dirty: set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
         self.load_users()
+        # Общие счётчики считаются один раз при загрузке и дальше обновляются инкрементально
+        self._total_messages = 0
+        self._total_images = 0
+        for user in self.users.values():
+            self._total_messages += user["messages_sent"]
+            self._total_images += user["images_generated"]
 
     def register_user(self, user_id: int, username: str):
         if user_id not in self.users:
+            now = _now_str()
             self.users[user_id] = {
                 "username": username,
-                "registration_date": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                "registration_date": now,
                 "messages_sent": 0,
                 "images_generated": 0,
-                "last_activity": datetime.now().strftime("%Y-%m-%d %H:%M")
+                "last_activity": now
             }
-            self.save_users()
+            self._dirty.add(user_id)
 
+    # Изменения только в памяти; на диск их сбрасывает schedule_flush()
     def update_activity(self, user_id: int):
         if user_id in self.users:
-            self.users[user_id]["last_activity"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-            self.save_users()
+            self.users[user_id]["last_activity"] = _now_str()
+            self._dirty.add(user_id)
 
     def increment_messages(self, user_id: int):
-        if user_id in self.users:
-            self.users[user_id]["messages_sent"] += 1
-            self.update_activity(user_id)
+        user = self.users.get(user_id)
+        if user is not None:
+            user["messages_sent"] += 1
+            self._total_messages += 1
+            user["last_activity"] = _now_str()
+            self._dirty.add(user_id)
 
     def increment_images(self, user_id: int):
-        if user_id in self.users:
-            self.users[user_id]["images_generated"] += 1
-            self.update_activity(user_id)
-
-    def get_user_stats(self, user_id: int) -> Dict:
-        if user_id in self.users:
-            return self.users[user_id].copy()
+        user = self.users.get(user_id)
+        if user is not None:
+            user["images_generated"] += 1
+            self._total_images += 1
+            user["last_activity"] = _now_str()
+            self._dirty.add(user_id)
+
+    def get_user_stats(self, user_id: int) -> Mapping:
+        # Представление только для чтения вместо копии словаря
+        user = self.users.get(user_id)
+        if user is not None:
+            return MappingProxyType(user)
         else:
-            return {
-                "username": "Неизвестный",
-                "registration_date": "Не зарегистрирован",
-                "messages_sent": 0,
-                "images_generated": 0,
-                "last_activity": "Никогда"
-            }
+            return _UNKNOWN_USER_STATS
 
     def get_total_stats(self) -> Dict:
-        total_users = len(self.users)
-        total_messages = sum(user["messages_sent"] for user in self.users.values())
-        total_images = sum(user["images_generated"] for user in self.users.values())
-
         return {
-            "total_users": total_users,
-            "total_messages": total_messages,
-            "total_images": total_images
+            "total_users": len(self.users),
+            "total_messages": self._total_messages,
+            "total_images": self._total_images
         }
 
-    def save_users(self):
+    def schedule_flush(self):
+        # Все изменения за окно flush_delay попадают в одну запись
+        if not self._dirty:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._debounced_flush())
+
+    async def _debounced_flush(self):
+        # Повторяем, пока есть несохранённые изменения: они могли появиться во время
+        # записи в потоке или остаться после неудачной записи
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+            if not self._dirty:
+                break
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            # Снимок изменённых строк берём в event loop, а в базу пишем в отдельном потоке
+            rows = self._collect_dirty()
+            if not await asyncio.to_thread(self._write_users, rows):
+                # Не удалось записать — попробуем снова при следующем сбросе
+                self._dirty.update(row[0] for row in rows)
+
+    def _collect_dirty(self) -> List[tuple]:
+        rows = []
+        for user_id in self._dirty:
+            user = self.users.get(user_id)
+            if user is not None:
+                rows.append((
+                    user_id,
+                    user["username"],
+                    user["registration_date"],
+                    user["messages_sent"],
+                    user["images_generated"],
+                    user["last_activity"]
+                ))
+        self._dirty.clear()
+        return rows
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write_users(self, rows: List[tuple]) -> bool:
         try:
-            with open("users.json", "w", encoding="utf-8") as f:
-                json.dump(self.users, f, ensure_ascii=False, indent=2)
+            # Все строки пишутся одной транзакцией
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(_UPSERT_USER, rows)
+            return True
         except Exception as e:
             logger.error(f"Ошибка при сохранении данных пользователей: {e}")
+            return False
 
     def load_users(self):
         try:
-            with open("users.json", "r", encoding="utf-8") as f:
-                self.users = json.load(f)
-                # Конвертируем ключи обратно в int (JSON сохраняет их как строки)
-                self.users = {int(k): v for k, v in self.users.items()}
-        except FileNotFoundError:
-            self.users = {}
+            with closing(self._connect()) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(_USERS_SCHEMA)
+                rows = conn.execute(
+                    "SELECT user_id, username, registration_date, messages_sent, images_generated, last_activity "
+                    "FROM users"
+                ).fetchall()
+            self.users = {
+                row[0]: {
+                    "username": row[1],
+                    "registration_date": row[2],
+                    "messages_sent": row[3],
+                    "images_generated": row[4],
+                    "last_activity": row[5]
+                }
+                for row in rows
+            }
         except Exception as e:
             logger.error(f"Ошибка при загрузке данных пользователей: {e}")
             self.users = {}
+            return
+
+        if not self.users:
+            self._import_json()
+
+    def _import_json(self, path: str = "users.json"):
+        # Разовый перенос данных из старого формата хранения
+        try:
+            with open(path, "rb") as f:
+                users = orjson.loads(f.read())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при импорте {path}: {e}")
+            return
+
+        # Конвертируем ключи обратно в int (JSON сохраняет их как строки)
+        self.users = {int(k): v for k, v in users.items()}
+        self._dirty.update(self.users)
+        if self._write_users(self._collect_dirty()):
+            logger.info(f"Импортировано пользователей из {path}: {len(self.users)}")
+        else:
+            # Оставляем всех импортированных в очереди, чтобы первый же сброс записал их в базу
+            self._dirty.update(self.users)
 
 
 class MessageFormatter:
@@ -223,6 +476,10 @@ class ConfigManager:
         default_config = {
             "max_message_length": 4000,
             "max_history_length": 20,
+            "max_cached_histories": 10000,
+            "openai_concurrency": 30,
+            "image_concurrency": 5,
+            "image_cache_ttl": 1800,
             "image_sizes": ["256x256", "512x512", "1024x1024"],
             "allowed_image_formats": ["png", "jpg", "jpeg"],
             "rate_limits": {
@@ -237,8 +494,8 @@ class ConfigManager:
         }
 
         try:
-            with open("config.json", "r", encoding="utf-8") as f:
-                loaded_config = json.load(f)
+            with open("config.json", "rb") as f:
+                loaded_config = orjson.loads(f.read())
                 default_config.update(loaded_config)
                 return default_config
         except FileNotFoundError:
@@ -250,8 +507,8 @@ class ConfigManager:
 
     def save_config(self, config: Dict = None):
         try:
-            with open("config.json", "w", encoding="utf-8") as f:
-                json.dump(config or self.config, f, ensure_ascii=False, indent=2)
+            with open("config.json", "wb") as f:
+                f.write(orjson.dumps(config or self.config, option=orjson.OPT_INDENT_2))
         except Exception as e:
             logger.error(f"Ошибка сохранения конфигурации: {e}")
 